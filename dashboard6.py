@@ -3,39 +3,59 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
+import pyarrow
+import os
 from datetime import datetime
+from pathlib import Path
 
 # Configuração da Página (Deve ser o primeiro comando)
 st.set_page_config(page_title="Dashboard de Saúde - Análise de Correlações", layout="wide")
 
 # --- FUNÇÃO DE CARREGAMENTO E TRATAMENTO DE DADOS ---
-@st.cache_data
-def carregar_dados():
+def ler_csv_tratado():
     # Ler o arquivo CSV
     # Tenta ler com a codificação padrão, se falhar tenta latin-1
+    # Lê só as colunas usadas no painel; cidade e sexo já chegam como categorias
+    colunas = ['_id', 'sexo', 'cidade', 'dataNascimento', 'dataEntrada', 'queixa', 'diagnostico']
+    tipos = {'cidade': 'category', 'sexo': 'category', 'diagnostico': 'category'}
     try:
-        df = pd.read_csv("saude_processada.csv")
+        df = pd.read_csv("saude_processada.csv", usecols=colunas, dtype=tipos)
     except UnicodeDecodeError:
-        df = pd.read_csv("saude_processada.csv", encoding="latin-1")
+        df = pd.read_csv("saude_processada.csv", encoding="latin-1", usecols=colunas, dtype=tipos)
 
     # 1. Tratamento RIGOROSO de Valores "NÃO DEFINIDO"
-    # Converte para string primeiro para evitar erros
+    # O diagnóstico já chega como categoria (códigos inteiros + dicionário de valores), então a
+    # limpeza roda só sobre os valores distintos e depois é aplicada às linhas pelos códigos
     # Remove espaços em branco no início e fim
-    df['diagnostico'] = df['diagnostico'].astype(str).str.strip()
-    
-    # Regex poderosa: substitui .NÃO DEFINIDO. (com ou sem acento, com ou sem pontos) por NaN
-    # Explicação do regex: ^ (inicio) \.? (ponto opcional) N[ÃA]O (NÃO ou NAO) \s (espaço) DEFINIDO \.? (ponto opcional) $ (fim)
-    df['diagnostico'] = df['diagnostico'].replace(r'^\.?N[ÃA]O\s+DEFINIDO\.?$', np.nan, regex=True)
-    
-    # Remove strings que viraram "nan" texto por acidente
-    df['diagnostico'] = df['diagnostico'].replace('nan', np.nan)
+    categorias = df['diagnostico'].cat.categories.to_series().str.strip()
+
+    # Regex poderosa: marca .NÃO DEFINIDO. (com ou sem acento, com ou sem pontos) para virar NaN
+    # Explicação do regex: \.? (ponto opcional) N[ÃA]O (NÃO ou NAO) \s (espaço) DEFINIDO \.? (ponto opcional), texto inteiro
+    # Textos "nan" que venham no arquivo também viram NaN
+    indefinidos = categorias.str.fullmatch(r'\.?N[ÃA]O\s+DEFINIDO\.?') | (categorias == 'nan')
+
+    # Recodifica as linhas: valores que ficaram iguais após o strip se juntam numa categoria só,
+    # e o código -1 (NaN) continua NaN
+    codigos_novos, categorias_novas = pd.factorize(categorias.mask(indefinidos), sort=True)
+    codigos_novos = np.append(codigos_novos, -1)
+    df['diagnostico'] = pd.Categorical.from_codes(codigos_novos[df['diagnostico'].cat.codes.values],
+                                                  categories=categorias_novas)
+
+    # Versão em minúsculas da QUEIXA, calculada uma vez para a busca por termo; o tipo string do
+    # PyArrow faz o lower e o contains nos kernels vetorizados do Arrow em vez de um loop Python.
+    # A coluna original sai da base (só a busca usa a queixa), o que deixa o cache bem menor
+    df['queixa_lower'] = df.pop('queixa').astype('string[pyarrow]').str.lower()
 
     # 2. Conversão de Datas
     df['dataNascimento'] = pd.to_datetime(df['dataNascimento'], errors='coerce')
     df['dataEntrada'] = pd.to_datetime(df['dataEntrada'], errors='coerce')
 
     # 3. Cálculo da Idade (Baseada na Data de Entrada)
-    df['idade_no_atendimento'] = (df['dataEntrada'] - df['dataNascimento']).dt.days // 365
+    # Diferença de anos, descontando 1 se o aniversário ainda não chegou naquele ano
+    # (evita montar o array de timedelta e a divisão por 365)
+    entrada, nascimento = df['dataEntrada'].dt, df['dataNascimento'].dt
+    antes_do_aniversario = (entrada.month * 100 + entrada.day) < (nascimento.month * 100 + nascimento.day)
+    df['idade_no_atendimento'] = entrada.year - nascimento.year - antes_do_aniversario
     
     # Remover idades negativas ou irreais
     df = df[(df['idade_no_atendimento'] >= 0) & (df['idade_no_atendimento'] < 120)]
@@ -43,13 +63,170 @@ def carregar_dados():
     # 4. Criação de Faixas Etárias
     bins = [0, 2, 12, 19, 59, 120]
     labels = ['Bebê (0-2)', 'Criança (3-12)', 'Adolescente (13-19)', 'Adulto (20-59)', 'Idoso (60+)']
-    df['faixa_etaria'] = pd.cut(df['idade_no_atendimento'], bins=bins, labels=labels, right=False)
+    # Mesmos intervalos [início, fim) do pd.cut(right=False): a busca binária nos limites
+    # internos já devolve o código da faixa, montado direto como Categorical ordenado
+    codigos = np.searchsorted(bins[1:-1], df['idade_no_atendimento'].values, side='right').astype(np.int8)
+    df['faixa_etaria'] = pd.Categorical.from_codes(codigos, categories=labels, ordered=True)
 
     return df
 
+def salvar_parquet(df, parquet):
+    # Grava num arquivo temporário na mesma pasta e só então troca pelo definitivo (os.replace
+    # é atômico), para que uma gravação interrompida nunca deixe um Parquet pela metade
+    temporario = parquet.with_name(f"{parquet.name}.{os.getpid()}.tmp")
+    try:
+        df.to_parquet(temporario, engine='pyarrow', compression='zstd')
+        os.replace(temporario, parquet)
+    except OSError:
+        # Sem permissão de escrita ou disco cheio: segue só com o cache em memória
+        pass
+    finally:
+        temporario.unlink(missing_ok=True)
+
+@st.cache_data
+def carregar_dados():
+    # A base já tratada fica salva em Parquet (colunar, com tipos e categorias preservados),
+    # o que evita reler e limpar o CSV sempre que o app sobe. O arquivo só é reaproveitado
+    # se for mais novo que o CSV e que este script; senão é refeito a partir do CSV.
+    # Atenção: com o servidor rodando, o cache em memória do Streamlit só olha o código desta
+    # função. Mudar ler_csv_tratado ou o CSV não invalida carregar_dados nem as funções com
+    # "_df" abaixo; é preciso reiniciar o servidor ou usar "Clear cache" no menu do app
+    parquet = Path("saude_processada_dashboard6.parquet")
+    origens = [Path("saude_processada.csv"), Path(__file__)]
+    df = None
+    if parquet.exists() and all(parquet.stat().st_mtime >= p.stat().st_mtime for p in origens if p.exists()):
+        try:
+            df = pd.read_parquet(parquet, engine='pyarrow')
+        except (OSError, ValueError, pyarrow.lib.ArrowException):
+            # Parquet corrompido ou ilegível: refaz a partir do CSV logo abaixo
+            df = None
+        else:
+            # O Parquet devolve o texto como string[python]; volta ao armazenamento PyArrow
+            df['queixa_lower'] = df['queixa_lower'].astype('string[pyarrow]')
+    if df is None:
+        df = ler_csv_tratado()
+        salvar_parquet(df, parquet)
+
+    # Opções da barra lateral (cidades e limites de data) calculadas uma vez junto com a base
+    cidades_todas = list(df['cidade'].unique())
+    min_date = df['dataEntrada'].min().date()
+    max_date = df['dataEntrada'].max().date()
+    return df, cidades_todas, min_date, max_date
+
+# --- FUNÇÕES DE FILTRO E AGREGAÇÃO (CACHE) ---
+# Os parâmetros "_df" não entram no hash do Streamlit (o DataFrame base já vem do cache),
+# então a chave de cada função é só a combinação de filtros: (cidades, data_inicio, data_fim).
+# Isso parte do princípio de que a base não muda enquanto o servidor roda (ver carregar_dados).
+# O filtro guarda apenas as posições das linhas: devolver o DataFrame inteiro pelo cache
+# custaria uma cópia completa a cada rerun.
+# Como as chaves são livres (qualquer conjunto de cidades, período ou termo de busca), essas
+# funções guardam só as combinações mais recentes, para a memória do servidor não crescer sem limite.
+LIMITE_CACHE_FILTROS = 32
+
+def mascara_filtros(tabela, cidades, data_inicio, data_fim):
+    # Compara direto no buffer datetime64 (sem converter cada linha para datetime.date);
+    # o fim do período é exclusivo no dia seguinte para incluir o último dia inteiro
+    datas = tabela['dataEntrada'].values
+    return (
+        (datas >= np.datetime64(data_inicio)) &
+        (datas < np.datetime64(data_fim) + np.timedelta64(1, 'D')) &
+        tabela['cidade'].isin(cidades).values
+    )
+
+@st.cache_data(max_entries=LIMITE_CACHE_FILTROS)
+def indices_filtrados(_df, cidades, data_inicio, data_fim):
+    return np.flatnonzero(mascara_filtros(_df, cidades, data_inicio, data_fim))
+
+@st.cache_data
+def indices_por_diagnostico(_df):
+    # Posições (na base) das linhas de cada diagnóstico, montadas numa única passada
+    return _df.groupby('diagnostico', observed=True).indices
+
+def filtrar_dados(df, cidades, data_inicio, data_fim):
+    # take copia as linhas para blocos novos e contíguos (ordem C), então as colunas do
+    # resultado já chegam prontas para value_counts/groupby sem cópia extra
+    return df.take(indices_filtrados(df, cidades, data_inicio, data_fim))
+
+@st.cache_data(max_entries=LIMITE_CACHE_FILTROS)
+def indicadores_periodo(_df, cidades, data_inicio, data_fim):
+    # KPIs e contagem por sexo calculados juntos e guardados no mesmo cache dos filtros;
+    # o gráfico de pizza recebe só a contagem, não uma linha por atendimento
+    df_filtered = filtrar_dados(_df, cidades, data_inicio, data_fim)
+    contagem_sexo = df_filtered['sexo'].value_counts(sort=False)
+    return {
+        'atendimentos': len(df_filtered),
+        'pacientes': df_filtered['_id'].nunique(),
+        'media_idade': df_filtered['idade_no_atendimento'].mean(),
+        'sexo': contagem_sexo[contagem_sexo > 0],
+    }
+
+@st.cache_data
+def atendimentos_por_dia_cidade(_df):
+    # Contagem única sobre a base inteira: uma linha por (cidade, dia) com atendimento
+    return (_df.groupby(['cidade', _df['dataEntrada'].dt.normalize()], observed=True).size()
+            .rename('Atendimentos').reset_index())
+
+@st.cache_data(max_entries=LIMITE_CACHE_FILTROS)
+def atendimentos_por_mes(_df, cidades, data_inicio, data_fim):
+    # Filtra a tabela diária (bem menor que a base) e só então agrupa por mês
+    tabela = atendimentos_por_dia_cidade(_df)
+    tabela = tabela[mascara_filtros(tabela, cidades, data_inicio, data_fim)]
+    return tabela.set_index('dataEntrada').resample('M')['Atendimentos'].sum().reset_index()
+
+@st.cache_data
+def diagnosticos_por_dia_cidade(_df):
+    # Contagem única sobre a base inteira: uma linha por (cidade, dia, diagnóstico) com atendimento;
+    # diagnósticos nulos ficam de fora do agrupamento
+    return (_df.groupby(['cidade', _df['dataEntrada'].dt.normalize(), 'diagnostico'], observed=True).size()
+            .rename('Contagem').reset_index())
+
+@st.cache_data(max_entries=LIMITE_CACHE_FILTROS)
+def top_diagnosticos_periodo(_df, cidades, data_inicio, data_fim):
+    # Soma as contagens pré-agregadas dentro dos filtros em vez de recontar as linhas filtradas
+    tabela = diagnosticos_por_dia_cidade(_df)
+    tabela = tabela[mascara_filtros(tabela, cidades, data_inicio, data_fim)]
+    contagem = tabela.groupby('diagnostico', observed=True)['Contagem'].sum()
+    top_diagnosticos = contagem.nlargest(10).reset_index()
+    top_diagnosticos.columns = ['Diagnóstico', 'Contagem']
+    return top_diagnosticos
+
+@st.cache_data(max_entries=LIMITE_CACHE_FILTROS)
+def buscar_queixa(_df, cidades, data_inicio, data_fim, termo_busca):
+    df_filtered = filtrar_dados(_df, cidades, data_inicio, data_fim)
+    mascara = df_filtered['queixa_lower'].str.contains(termo_busca.lower(), regex=False, na=False)
+    return np.flatnonzero(mascara.to_numpy(dtype=bool))
+
+@st.cache_data(max_entries=LIMITE_CACHE_FILTROS)
+def tabela_cruzada_queixa(_df, cidades, data_inicio, data_fim, termo_busca):
+    df_filtered = filtrar_dados(_df, cidades, data_inicio, data_fim)
+    df_queixa = df_filtered.take(buscar_queixa(_df, cidades, data_inicio, data_fim, termo_busca))
+    # groupby + unstack monta a mesma tabela do crosstab sem o pivot intermediário;
+    # as faixas já saem na ordem das categorias de faixa_etaria
+    return df_queixa.groupby(['faixa_etaria', 'sexo'], observed=True).size().unstack(fill_value=0)
+
+@st.cache_data(max_entries=LIMITE_CACHE_FILTROS)
+def resumo_idade_queixa(_df, cidades, data_inicio, data_fim, termo_busca):
+    # Estatísticas do boxplot por sexo (quartis e bigodes a 1,5 IQR; os pontos fora dos bigodes
+    # voltam só como idades distintas), para o gráfico receber um resumo por grupo e não todos os pontos
+    df_filtered = filtrar_dados(_df, cidades, data_inicio, data_fim)
+    df_queixa = df_filtered.take(buscar_queixa(_df, cidades, data_inicio, data_fim, termo_busca))
+    resumo = {}
+    for sexo, idades in df_queixa.groupby('sexo', observed=True)['idade_no_atendimento']:
+        idades = idades.dropna().to_numpy()
+        if idades.size == 0:
+            continue
+        # Quartis com interpolação 'hazen', a mais próxima do que o Plotly calcula a partir dos pontos
+        q1, mediana, q3 = np.percentile(idades, [25, 50, 75], method='hazen')
+        iqr = q3 - q1
+        no_bigode = (idades >= q1 - 1.5 * iqr) & (idades <= q3 + 1.5 * iqr)
+        resumo[sexo] = {'q1': q1, 'mediana': mediana, 'q3': q3,
+                        'limite_inferior': idades[no_bigode].min(), 'limite_superior': idades[no_bigode].max(),
+                        'outliers': np.unique(idades[~no_bigode])}
+    return pd.DataFrame.from_dict(resumo, orient='index')
+
 # Carrega os dados
 try:
-    df = carregar_dados()
+    df, cidades_todas, min_date, max_date = carregar_dados()
 except FileNotFoundError:
     st.error("Erro: O arquivo 'saude_processada.csv' não foi encontrado na mesma pasta do script.")
     st.stop()
@@ -61,19 +238,13 @@ labels_faixa = ['Bebê (0-2)', 'Criança (3-12)', 'Adolescente (13-19)', 'Adulto
 st.sidebar.header("Filtros Globais")
 
 # Filtro de Cidade
-if 'cidade' in df.columns:
-    cidades = st.sidebar.multiselect(
-        "Selecione a Cidade:",
-        options=df['cidade'].unique(),
-        default=df['cidade'].unique()
-    )
-else:
-    cidades = []
+cidades = st.sidebar.multiselect(
+    "Selecione a Cidade:",
+    options=cidades_todas,
+    default=cidades_todas
+)
 
 # Filtro de Data
-min_date = df['dataEntrada'].min().date()
-max_date = df['dataEntrada'].max().date()
-
 try:
     data_inicio, data_fim = st.sidebar.date_input(
         "Período de Análise:",
@@ -86,11 +257,8 @@ except ValueError:
     data_inicio, data_fim = min_date, max_date
 
 # Aplicar Filtros
-df_filtered = df[
-    (df['cidade'].isin(cidades)) &
-    (df['dataEntrada'].dt.date >= data_inicio) &
-    (df['dataEntrada'].dt.date <= data_fim)
-]
+filtros = (tuple(sorted(cidades)), data_inicio, data_fim)
+df_filtered = filtrar_dados(df, *filtros)
 
 # --- LAYOUT DO DASHBOARD ---
 
@@ -98,16 +266,16 @@ st.title("🏥 Dashboard de Análise Clínica e Epidemiológica")
 st.markdown("Este painel visa identificar correlações entre perfis demográficos e diagnósticos clínicos.")
 
 # KPIs
+indicadores = indicadores_periodo(df, *filtros)
 kpi1, kpi2, kpi3, kpi4 = st.columns(4)
-kpi1.metric("Total de Atendimentos", f"{len(df_filtered):,}")
-kpi2.metric("Pacientes Únicos", f"{df_filtered['_id'].nunique():,}")
-kpi3.metric("Média de Idade", f"{df_filtered['idade_no_atendimento'].mean():.1f} anos")
+kpi1.metric("Total de Atendimentos", f"{indicadores['atendimentos']:,}")
+kpi2.metric("Pacientes Únicos", f"{indicadores['pacientes']:,}")
+kpi3.metric("Média de Idade", f"{indicadores['media_idade']:.1f} anos")
 
 # KPI de Diagnóstico mais comum (ignora Nulos)
-try:
-    top_diag = df_filtered['diagnostico'].dropna().value_counts().idxmax()
-except:
-    top_diag = "N/A"
+# Reaproveita o ranking da Seção 3 (já ordenado e em cache) em vez de recontar os diagnósticos
+top_diagnosticos = top_diagnosticos_periodo(df, *filtros)
+top_diag = top_diagnosticos['Diagnóstico'].iloc[0] if len(top_diagnosticos) else "N/A"
 kpi4.metric("Diagnóstico + Comum", top_diag)
 
 st.markdown("---")
@@ -117,14 +285,15 @@ col1, col2 = st.columns([2, 1])
 
 with col1:
     st.subheader("Evolução dos Atendimentos")
-    vendas_tempo = df_filtered.set_index('dataEntrada').resample('M').size().reset_index(name='Atendimentos')
+    vendas_tempo = atendimentos_por_mes(df, *filtros)
     fig_line = px.line(vendas_tempo, x='dataEntrada', y='Atendimentos', markers=True, 
                        title="Tendência Temporal")
     st.plotly_chart(fig_line, use_container_width=True)
 
 with col2:
     st.subheader("Distribuição por Gênero")
-    fig_pie = px.pie(df_filtered, names='sexo', title="Gênero", hole=0.4,
+    fig_pie = px.pie(names=indicadores['sexo'].index, values=indicadores['sexo'].values,
+                     title="Gênero", hole=0.4,
                      color_discrete_sequence=px.colors.qualitative.Pastel)
     st.plotly_chart(fig_pie, use_container_width=True)
 
@@ -142,57 +311,77 @@ with tab1:
         diag_selecionado = st.selectbox("Selecione um Diagnóstico:", options=np.sort(lista_diagnosticos))
 
         if diag_selecionado:
-            df_diag = df_filtered[df_filtered['diagnostico'] == diag_selecionado]
+            df_diag = df.take(np.intersect1d(indices_por_diagnostico(df)[diag_selecionado],
+                                         indices_filtrados(df, *filtros), assume_unique=True))
             
             st.markdown(f"### Perfil: **{diag_selecionado}** ({len(df_diag)} casos)")
             
             c1, c2 = st.columns(2)
             with c1:
-                fig_bar_age = px.histogram(df_diag, x="faixa_etaria", color="sexo", 
-                                           title="Faixa Etária e Sexo",
-                                           category_orders={"faixa_etaria": labels_faixa},
-                                           text_auto=True, barmode='group')
+                # Conta só as combinações (faixa, sexo) que existem (observed=True) e manda as contagens
+                # prontas para o gráfico, em vez de uma linha por atendimento
+                contagem_faixa = (df_diag.groupby(['faixa_etaria', 'sexo'], observed=True).size()
+                                  .reset_index(name='count'))
+                fig_bar_age = px.bar(contagem_faixa, x="faixa_etaria", y="count", color="sexo",
+                                     title="Faixa Etária e Sexo",
+                                     category_orders={"faixa_etaria": labels_faixa},
+                                     text_auto=True, barmode='group')
                 st.plotly_chart(fig_bar_age, use_container_width=True)
                 
             with c2:
-                fig_hist = px.histogram(df_diag, x="idade_no_atendimento", nbins=20, 
-                                        title="Idade Detalhada",
-                                        color_discrete_sequence=['#636EFA'])
-                fig_hist.update_layout(bargap=0.1)
+                # Contagem por faixa feita no NumPy: o gráfico recebe só as barras, não cada idade.
+                # Faixas de anos inteiros (no máximo ~20), para cada barra cobrir idades exatas
+                idades = df_diag['idade_no_atendimento'].dropna().to_numpy()
+                lo, hi = (int(idades.min()), int(idades.max())) if idades.size else (0, 0)
+                largura = max(1, int(np.ceil((hi - lo + 1) / 20)))
+                contagens, limites = np.histogram(idades, bins=np.arange(lo, hi + largura + 1, largura))
+                fig_hist = go.Figure(go.Bar(x=(limites[:-1] + limites[1:]) / 2, y=contagens,
+                                            marker_color='#636EFA'))
+                fig_hist.update_layout(title="Idade Detalhada", bargap=0.1,
+                                       xaxis_title="idade_no_atendimento", yaxis_title="count")
                 st.plotly_chart(fig_hist, use_container_width=True)
     else:
         st.warning("Não há diagnósticos definidos no período selecionado.")
 
 with tab2:
-    termo_busca = st.text_input("Buscar termo na QUEIXA (Ex: dor, febre):", "")
+    # Dentro do formulário o termo só é aplicado ao clicar em "Buscar": digitar não dispara
+    # a busca e os gráficos a cada alteração, e o último termo buscado continua valendo
+    with st.form("busca_queixa"):
+        termo_busca = st.text_input("Buscar termo na QUEIXA (Ex: dor, febre):", "")
+        st.form_submit_button("Buscar")
     
     if termo_busca:
-        df_queixa = df_filtered[df_filtered['queixa'].astype(str).str.contains(termo_busca, case=False, na=False)]
+        df_queixa = df_filtered.take(buscar_queixa(df, *filtros, termo_busca))
         
         st.markdown(f"### Perfil para termo: **'{termo_busca}'** ({len(df_queixa)} casos)")
         
         if not df_queixa.empty:
             c3, c4 = st.columns(2)
             with c3:
-                heatmap_data = pd.crosstab(df_queixa['faixa_etaria'], df_queixa['sexo'])
+                heatmap_data = tabela_cruzada_queixa(df, *filtros, termo_busca)
                 fig_heat = px.imshow(heatmap_data, text_auto=True, aspect="auto",
                                      title=f"Mapa de Calor: Intensidade",
                                      color_continuous_scale='Viridis')
                 st.plotly_chart(fig_heat, use_container_width=True)
             with c4:
-                fig_box = px.box(df_queixa, x="sexo", y="idade_no_atendimento", points="all",
-                                 title="Boxplot de Idade", color="sexo")
+                resumo_idade = resumo_idade_queixa(df, *filtros, termo_busca)
+                fig_box = go.Figure()
+                for cor, (sexo, linha) in zip(px.colors.qualitative.Plotly, resumo_idade.iterrows()):
+                    fig_box.add_trace(go.Box(name=sexo, q1=[linha['q1']], median=[linha['mediana']], q3=[linha['q3']],
+                                             lowerfence=[linha['limite_inferior']], upperfence=[linha['limite_superior']],
+                                             marker_color=cor))
+                    # Pontos fora dos bigodes em um traço à parte, na mesma cor da caixa
+                    fig_box.add_trace(go.Scatter(x=[sexo] * len(linha['outliers']), y=linha['outliers'],
+                                                 mode='markers', marker_color=cor, showlegend=False))
+                fig_box.update_layout(title="Boxplot de Idade",
+                                      xaxis_title="sexo", yaxis_title="idade_no_atendimento")
                 st.plotly_chart(fig_box, use_container_width=True)
 
 # --- SEÇÃO 3: RANKING ---
 st.markdown("---")
 st.subheader("Top 10 Diagnósticos (Excluindo 'Não Definido')")
 
-# Filtra explicitamente nulos antes de contar
-df_clean_diag = df_filtered.dropna(subset=['diagnostico'])
-top_diagnosticos = df_clean_diag['diagnostico'].value_counts().head(10).reset_index()
-top_diagnosticos.columns = ['Diagnóstico', 'Contagem']
-
+# Top 10 calculado junto com os KPIs; nulos são descartados dentro da função antes de contar
 if not top_diagnosticos.empty:
     fig_bar_horiz = px.bar(top_diagnosticos, x='Contagem', y='Diagnóstico', orientation='h',
                            title="Ranking de Ocorrências", text='Contagem',